@@ -1,178 +1,383 @@
-from enum import Enum, auto
-from typing import Tuple, Optional
+from enum import IntEnum, auto
+from typing import Callable, Final, Iterator, Optional, Union
+import mmap
+import os
 import struct
+import sys
 
 #constant declarations
 PAGE_SIZE = 4096
 TABLE_MAX_PAGES = 100
 
-class MetaCommandResult(Enum):
+class MetaCommandResult(IntEnum):
     """Statuses for meta command execution"""
     SUCCESS = auto()
     UNRECOGNIZED_COMMAND = auto()
 
-class PrepareResult(Enum):
-    """Statuses to be returned while parsing the command input by the users."""
+class ExecuteResult(IntEnum):
+    """Statuses to be returned while parsing and executing the statements input by the users."""
     SUCCESS = auto()
+    TABLE_FULL = auto()
     SYNTAX_ERROR = auto()
     UNRECOGNIZED_STATEMENT = auto()
 
-class ExecuteResult(Enum):
-    SUCCESS = auto()
-    TABLE_FULL = auto()
-    
-class StatementType(Enum):
-    """Various statement types supported by the db engine."""
-    INSERT = auto()
-    SELECT = auto()
-
 class Row:
     """Represents a row in our database table"""
+    __slots__ = ('id', '_username_b', '_email_b')
     
     #constant declarations at the row level
-    ID_SIZE = 4
-    USERNAME_SIZE = 32
-    EMAIL_SIZE = 255
-    ROW_SIZE = ID_SIZE + USERNAME_SIZE + EMAIL_SIZE
+    ID_SIZE:Final = 4
+    USERNAME_SIZE:Final = 32
+    EMAIL_SIZE:Final = 255
+    ROW_SIZE:Final = ID_SIZE + USERNAME_SIZE + EMAIL_SIZE
+    #ids are stored as unsigned 32 bit integers
+    ID_MAX:Final = 2**(8*ID_SIZE) - 1
     
     #offset calculations
-    ID_OFFSET = 0
-    USERNAME_OFFSET = ID_OFFSET + ID_SIZE
-    EMAIL_OFFSET = USERNAME_OFFSET + USERNAME_SIZE
+    ID_OFFSET:Final = 0
+    USERNAME_OFFSET:Final = ID_OFFSET + ID_SIZE
+    EMAIL_OFFSET:Final = USERNAME_OFFSET + USERNAME_SIZE
      
-    def __init__(self, id:int=0, username:str="", email:str=""):
+    def __init__(self, id:int=0, username:str="", email:str="")->None:
         self.id = id
+        #the string fields are held encoded and zero padded to their size by
+        #the property setters, so serializing a row is a plain copy
         self.username = username
         self.email = email
 
-    def __str__(self):
+    @staticmethod
+    def from_packed(id_val:int, username:bytes, email:bytes)->'Row':
+        """Build a row from fields already in their packed, zero padded form"""
+        row = Row.__new__(Row)
+        row.id = id_val
+        row._username_b = username
+        row._email_b = email
+        return row
+
+    @property
+    def username(self)->str:
+        return _decode_field(self._username_b)
+
+    @username.setter
+    def username(self, value:str)->None:
+        self._username_b = _pack_field(value, self.USERNAME_SIZE)
+
+    @property
+    def email(self)->str:
+        return _decode_field(self._email_b)
+
+    @email.setter
+    def email(self, value:str)->None:
+        self._email_b = _pack_field(value, self.EMAIL_SIZE)
+
+    def __str__(self)->str:
         return f"({self.id}, {self.username}, {self.email})"
 
     def serialize(self)->bytes:
         """Convert row into a compact binary representation"""
-        packed_id = struct.pack("I", self.id)
-        packed_username = self.username.encode('utf-8')[:self.USERNAME_SIZE].ljust(self.USERNAME_SIZE, b'\x00')
-        packed_email = self.email.encode('utf-8')[:self.EMAIL_SIZE].ljust(self.EMAIL_SIZE, b'\x00')
+        return _ROW_STRUCT.pack(self.id, self._username_b, self._email_b)
+
+    def serialize_into(self, buf:Union[bytearray, memoryview], offset:int)->None:
+        """Write the binary representation of the row directly into buf at offset"""
+        _ROW_STRUCT.pack_into(buf, offset, self.id, self._username_b, self._email_b)
 
-        return packed_id + packed_username + packed_email
+    def serialize_view(self)->memoryview:
+        """Binary representation of the row packed into a shared scratch buffer.
+            The view is only valid until the next call, use serialize() to own the bytes."""
+        self.serialize_into(_SCRATCH, 0)
+        return _SCRATCH_VIEW
 
     @staticmethod
     def deserialize(data:bytes)->'Row':
         """Convert binary data back to Row object"""
-        id_val = struct.unpack('I', data[Row.ID_OFFSET:Row.ID_OFFSET+Row.ID_SIZE])[0]
-        username = data[Row.USERNAME_OFFSET: Row.USERNAME_OFFSET+Row.USERNAME_SIZE].rstrip(b'\x00').decode('utf-8')
-        email = data[Row.EMAIL_OFFSET: Row.EMAIL_OFFSET+Row.EMAIL_SIZE].rstrip(b'\x00').decode('utf-8')
+        return Row.from_packed(*_ROW_STRUCT.unpack_from(data, 0))
+
+#precompiled layout of a row: id, username, email
+_ROW_STRUCT = struct.Struct(f"<I{Row.USERNAME_SIZE}s{Row.EMAIL_SIZE}s")
+#scratch buffer reused by Row.serialize_view
+_SCRATCH = bytearray(Row.ROW_SIZE)
+_SCRATCH_VIEW = memoryview(_SCRATCH)
+
+def _encode_field(value:str)->bytes:
+    """Encode a string field, taking the cheaper ascii codec when possible"""
+    return value.encode('ascii') if value.isascii() else value.encode('utf-8')
 
-        return Row(id_val, username, email)
+def _decode_field(raw:bytes)->str:
+    """Decode a zero padded string field. Invalid utf-8, e.g. a character cut in half
+        by an older writer, is replaced rather than making the stored row unreadable."""
+    return raw.rstrip(b'\x00').decode('utf-8', 'replace')
+
+def _pack_field(value:str, size:int)->bytes:
+    """Encode a string field truncated on a character boundary and zero padded to its fixed size"""
+    encoded = _encode_field(value)
+    if len(encoded) > size and not value.isascii():
+        #drop the partial multibyte character the cut would leave behind
+        encoded = encoded[:size].decode('utf-8', 'ignore').encode('utf-8')
+    return encoded[:size].ljust(size, b'\x00')
+
+#layout of the table header: magic, num_rows
+_HEADER_STRUCT = struct.Struct("<4sI")
+_HEADER_MAGIC = b"PYDB"
 
 class Table:
     """Represents the database table"""
-    ROWS_PER_PAGE = PAGE_SIZE//Row.ROW_SIZE
-    TABLE_MAX_ROWS = TABLE_MAX_PAGES * ROWS_PER_PAGE
+    ROWS_PER_PAGE:Final = PAGE_SIZE//Row.ROW_SIZE
+    TABLE_MAX_ROWS:Final = TABLE_MAX_PAGES * ROWS_PER_PAGE
+    #the header takes a whole page so the row pages stay page aligned
+    HEADER_SIZE:Final = PAGE_SIZE
+    FILE_SIZE:Final = HEADER_SIZE + TABLE_MAX_PAGES * PAGE_SIZE
 
-    def __init__(self):
+    def __init__(self, filename:Optional[str]=None)->None:
+        """Map the table storage into memory. When a filename is given the pages
+            are backed by that file and the rows already in it are loaded,
+            otherwise the table lives in anonymous memory.
+            Raises ValueError when the file is not a database file."""
+        self.fd = -1
         self.num_rows = 0
-        self.pages = [None] * TABLE_MAX_PAGES
+        if filename is None:
+            self.mm = mmap.mmap(-1, self.FILE_SIZE)
+            _HEADER_STRUCT.pack_into(self.mm, 0, _HEADER_MAGIC, 0)
+        else:
+            self.fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o644)
+            file_size = os.fstat(self.fd).st_size
+            #validate before touching the file so a foreign file is never resized
+            if file_size not in (0, self.FILE_SIZE):
+                os.close(self.fd)
+                raise ValueError(f"'{filename}' is not a database file: expected {self.FILE_SIZE} bytes, found {file_size}.")
+            if file_size == 0:
+                os.ftruncate(self.fd, self.FILE_SIZE)
+            self.mm = mmap.mmap(self.fd, self.FILE_SIZE)
+            if file_size == 0:
+                _HEADER_STRUCT.pack_into(self.mm, 0, _HEADER_MAGIC, 0)
+            magic, num_rows = _HEADER_STRUCT.unpack_from(self.mm, 0)
+            if magic != _HEADER_MAGIC or num_rows > self.TABLE_MAX_ROWS:
+                self.mm.close()
+                os.close(self.fd)
+                raise ValueError(f"'{filename}' is not a database file: invalid header.")
+            self.num_rows = num_rows
+        self.view = memoryview(self.mm)
+        #page views are created lazily, keyed by page number
+        self.pages:dict[int, memoryview] = {}
+        #row id to the (page_num, byte_offset) holding it, for point lookups
+        self.id_index:dict[int, tuple[int, int]] = {}
+        for row_num in range(self.num_rows):
+            page_num, byte_offset = self.row_slot(row_num)
+            self.id_index[_ROW_STRUCT.unpack_from(self.pages[page_num], byte_offset)[0]] = (page_num, byte_offset)
+
+    def close(self)->None:
+        """Flush the pages to disk and release the mapping, closing twice is a no-op"""
+        if self.mm.closed:
+            return
+        self.pages.clear()
+        self.view.release()
+        if self.fd >= 0:
+            self.mm.flush()
+        self.mm.close()
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
 
     def row_slot(self, row_num:int)->tuple[int, int]:
         """Calculate which page and byte offset a row must be inserted.
             Returns a tuple (page_num, byte_offset)"""
         page_num = row_num//self.ROWS_PER_PAGE
 
-        if self.pages[page_num] is None:
-            self.pages[page_num] = bytearray(PAGE_SIZE)
+        if page_num not in self.pages:
+            start = self.HEADER_SIZE + page_num*PAGE_SIZE
+            self.pages[page_num] = self.view[start:start+PAGE_SIZE]
 
         row_offset = row_num%self.ROWS_PER_PAGE
         byte_offset = row_offset * Row.ROW_SIZE
         
         return page_num, byte_offset
 
-    def insert_row(self, row:Row):
+    def insert_row(self, row:Row)->None:
         """Insert a row into the table"""
         page_num, byte_offset = self.row_slot(self.num_rows)
-        serialized = row.serialize()
-        self.pages[page_num][byte_offset:byte_offset+Row.ROW_SIZE] = serialized
+        row.serialize_into(self.pages[page_num], byte_offset)
+        self.id_index[row.id] = (page_num, byte_offset)
         self.num_rows +=1
+        #the row count lives in the mapped header, so it is never out of date
+        #with the pages even if the process stops without closing the table
+        _HEADER_STRUCT.pack_into(self.view, 0, _HEADER_MAGIC, self.num_rows)
 
-    def select_all(self)->list[Row]:
-        rows = []
-        for i in range(self.num_rows):
-            page_num, byte_offset = self.row_slot(i)
-            row_data = bytes(self.pages[page_num][byte_offset: byte_offset+Row.ROW_SIZE])
-            rows.append(Row.deserialize(row_data))
-        return rows
-        
-class Statement:
-    def __init__(self, statement_type:StatementType, row:Optional[Row])->None:
-        self.type = statement_type
-        self.row_to_insert = row
+    def select_by_id(self, id_val:int)->Optional[Row]:
+        """Fetch a single row through the id index, None if no row has that id"""
+        slot = self.id_index.get(id_val)
+        if slot is None:
+            return None
+        page_num, byte_offset = slot
+        return Row.from_packed(*_ROW_STRUCT.unpack_from(self.pages[page_num], byte_offset))
 
+    def iter_rows(self)->Iterator[tuple[int, bytes, bytes]]:
+        """Yield the raw (id, username, email) tuples of every row without
+            building Row objects. The string fields are still zero padded."""
+        remaining = self.num_rows
+        page_num = 0
+        while remaining > 0:
+            #unpack all the used rows of a page in one call
+            rows_in_page = min(remaining, self.ROWS_PER_PAGE)
+            start = self.HEADER_SIZE + page_num*PAGE_SIZE
+            used = self.view[start:start+rows_in_page*Row.ROW_SIZE]
+            yield from _ROW_STRUCT.iter_unpack(used)
+            remaining -= rows_in_page
+            page_num += 1
 
-def print_prompt():
+    def select_all(self)->list[Row]:
+        return [Row.from_packed(id_val, username, email) for id_val, username, email in self.iter_rows()]
+        
+def print_prompt()->None:
     """The main prompt to accept user inputs"""
     print("db >", end="", flush=True)
 
-def do_meta_command(command:str)->MetaCommandResult:
+def do_meta_command(command:str, table:Table)->MetaCommandResult:
     """This function handles the meta commands which starts with a ."""
     if command == '.exit':
+        table.close()
         print("Goodbye!")
-        exit(0)
+        sys.exit(0)
     return MetaCommandResult.UNRECOGNIZED_COMMAND
 
-def prepare_statement(input_string:str)->Tuple[PrepareResult, Optional[Statement]]:
-    """This function parses the user input and returns the approriate result..."""
-    if input_string.startswith("insert"):
-        parts = input_string.split()
-        try:
-            id_val = int(parts[1])
-            username = parts[2]
-            email = parts[3]
-            row = Row(id_val, username, email)
-            return PrepareResult.SUCCESS, Statement(StatementType.INSERT, row)
-        except(ValueError, IndexError):
-            return PrepareResult.SYNTAX_ERROR, None
-            
-    elif input_string.startswith("select"):
-        return PrepareResult.SUCCESS, Statement(StatementType.SELECT, None)
-
-    return PrepareResult.UNRECOGNIZED_STATEMENT, None
-
-def execute_statement(statement: Statement, table: Table)->ExecuteResult:
-    if statement.type == StatementType.INSERT:
-        if table.num_rows >= Table.TABLE_MAX_ROWS:
-            return ExecuteResult.TABLE_FULL
-        table.insert_row(statement.row_to_insert)
+def _execute_insert(args:str, table:Table, batch:Optional[list[Row]])->ExecuteResult:
+    """Parses the arguments of an insert statement: id username email, and inserts
+        the row, or only collects it when a batch is in progress"""
+    #split off at most the three fields in one call, any trailing tokens stay
+    #together in a fourth part and are ignored
+    parts = args.split(None, 3)
+    if len(parts) < 3:
+        return ExecuteResult.SYNTAX_ERROR
+    try:
+        id_val = int(parts[0])
+    except(ValueError):
+        return ExecuteResult.SYNTAX_ERROR
+    if not 0 <= id_val <= Row.ID_MAX:
+        return ExecuteResult.SYNTAX_ERROR
+    row = Row(id_val, parts[1], parts[2])
+
+    if batch is not None:
+        batch.append(row)
         return ExecuteResult.SUCCESS
-    elif statement.type == StatementType.SELECT:
-        rows = table.select_all()
-        for row in rows:
+    if table.num_rows >= Table.TABLE_MAX_ROWS:
+        return ExecuteResult.TABLE_FULL
+    table.insert_row(row)
+    return ExecuteResult.SUCCESS
+
+def _execute_select(args:str, table:Table, batch:Optional[list[Row]])->ExecuteResult:
+    """Parses the arguments of a select statement: an optional row id, and prints
+        the matching rows. Rows pending in a batch are not visible."""
+    args = args.strip()
+    if args:
+        try:
+            select_id = int(args)
+        except(ValueError):
+            return ExecuteResult.SYNTAX_ERROR
+        row = table.select_by_id(select_id)
+        if row is not None:
             print(row)
         return ExecuteResult.SUCCESS
 
-def main():
-    print_prompt()
-    table = Table()
-    while True:
-        try:
-            user_input = input().strip()
-        except(EOFError):
-            print("\nerror reading input")
-
-        if user_input.startswith('.'):
-            result = do_meta_command(user_input)
-            if result == MetaCommandResult.UNRECOGNIZED_COMMAND:
-                print(f"unrecognized command '{user_input}.'")
-            continue
-
-        result, statement = prepare_statement(user_input)
-        if result == PrepareResult.SYNTAX_ERROR:
-            print(f"error while parsing the statement.")
-            continue
-        if result == PrepareResult.UNRECOGNIZED_STATEMENT:
-            print(f"unrecognized statement '{user_input}'.")
-            continue
-
-        execute_statement(statement, table)
+    #format straight from the packed tuples, no Row objects are built, and
+    #hand the whole result to stdout in a single write
+    lines:list[str] = []
+    append = lines.append
+    for id_val, raw_username, raw_email in table.iter_rows():
+        username = _decode_field(raw_username)
+        email = _decode_field(raw_email)
+        append(f"({id_val}, {username}, {email})\n")
+    sys.stdout.write("".join(lines))
+    return ExecuteResult.SUCCESS
+
+#statement keyword to the function parsing and executing the rest of the statement
+_HANDLERS:dict[str, Callable[[str, Table, Optional[list[Row]]], ExecuteResult]] = {
+    "insert": _execute_insert,
+    "select": _execute_select,
+}
+
+def parse_and_execute(input_string:str, table:Table, batch:Optional[list[Row]]=None)->ExecuteResult:
+    """This function parses the user input and executes it against the table in one go.
+        Inserts are appended to batch instead when one is given."""
+    #the keyword ends at the first run of whitespace, spaces or tabs
+    parts = input_string.split(None, 1)
+    handler = _HANDLERS.get(parts[0]) if parts else None
+    if handler is None:
+        return ExecuteResult.UNRECOGNIZED_STATEMENT
+    return handler(parts[1] if len(parts) > 1 else "", table, batch)
+
+def execute_batch(rows:list[Row], table:Table)->ExecuteResult:
+    """Insert a batch of already parsed rows in a single pass"""
+    insert_row = table.insert_row
+    for row in rows:
+        if table.num_rows >= Table.TABLE_MAX_ROWS:
+            return ExecuteResult.TABLE_FULL
+        insert_row(row)
+    return ExecuteResult.SUCCESS
+
+def main()->None:
+    #an optional database file makes the table persistent
+    try:
+        table = Table(sys.argv[1] if len(sys.argv) > 1 else None)
+    except(OSError, ValueError) as e:
+        print(f"error opening the database: {e}")
+        sys.exit(1)
+    #inserts collected between .begin and .commit, None outside a batch
+    pending:Optional[list[Row]] = None
+    #bind the per command callables locally to skip global lookups in the loop
+    readline = sys.stdin.buffer.readline
+    run = parse_and_execute
+    #only prompt a user at a terminal, not piped in scripts
+    interactive = sys.stdin.isatty()
+    try:
+        while True:
+            if interactive:
+                print_prompt()
+            raw = readline()
+            if not raw:
+                #the end of a piped script is a normal way to finish, unless
+                #it leaves a batch open
+                if not interactive and pending is None:
+                    sys.exit(0)
+                print("\nerror reading input")
+                if pending:
+                    print(f"{len(pending)} rows were not committed and are discarded.")
+                sys.exit(1)
+            raw = raw.strip()
+            if not raw:
+                continue
+            user_input = raw.decode('utf-8')
+
+            #a single first character test separates meta commands from statements,
+            #statements are then dispatched on their keyword by parse_and_execute
+            if user_input[0] == '.':
+                if user_input == '.begin':
+                    if pending is not None:
+                        print("a batch is already in progress.")
+                    else:
+                        pending = []
+                elif user_input == '.commit':
+                    if pending is None:
+                        print("no batch in progress.")
+                    else:
+                        num_rows = table.num_rows
+                        if execute_batch(pending, table) == ExecuteResult.TABLE_FULL:
+                            skipped = len(pending) - (table.num_rows - num_rows)
+                            print(f"error: table full, {skipped} rows of the batch were not inserted.")
+                        pending = None
+                elif user_input == '.exit' and pending:
+                    print(f"{len(pending)} rows are not committed, run .commit before exiting.")
+                elif do_meta_command(user_input, table) == MetaCommandResult.UNRECOGNIZED_COMMAND:
+                    print(f"unrecognized command '{user_input}.'")
+                continue
+
+            result = run(user_input, table, pending)
+            if result == ExecuteResult.SYNTAX_ERROR:
+                print(f"error while parsing the statement.")
+            elif result == ExecuteResult.UNRECOGNIZED_STATEMENT:
+                print(f"unrecognized statement '{user_input}'.")
+            elif result == ExecuteResult.TABLE_FULL:
+                print("error: table full.")
+    finally:
+        #release the mapping on .exit, errors and interrupts alike
+        table.close()
 
 if __name__ == '__main__':
     main()